@@ -1,12 +1,27 @@
+import argparse
+import codecs
+import html
+import json
 import mimetypes
 import os
+import posixpath
+import queue
+import random
 import select
 import shutil
 import socket
+import stat
 import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlparse
 
-# Import BeautifulSoup, used to find the images.
-from bs4 import BeautifulSoup
+# Seconds to wait for the server before giving up on a connection.
+TIMEOUT = 30
 
 ##############################
 
@@ -15,10 +30,18 @@ from bs4 import BeautifulSoup
 class Request:
 
     # In the init, process the input arguments. Expects at least a method and an URL. If no port is given, default to 80
-    def __init__(self, list_of_input_element):
+    # For PUT and POST, the body can be given, or streamed from body_file (a path, or - for stdin). Otherwise, it is
+    # asked for. With expect_continue, the body is only sent when the server agrees (or does not answer in time).
+    def __init__(self, list_of_input_element, body=None, body_file=None, expect_continue=False):
 
         # Method
         self.method = list_of_input_element[0]
+        self.body = body
+        self.body_file = body_file
+        self.expect_continue = expect_continue
+
+        # Content codings the response may use. Set to None to ask for an uncompressed response.
+        self.accept_encoding = "gzip, deflate"
 
         if "http://" in list_of_input_element[1]:
             list_of_input_element[1] = list_of_input_element[1][7:]
@@ -44,22 +67,102 @@ class Request:
     def make_request(self):
         self.request = '{} {} HTTP/1.1\r\nHost: {}\r\n'.format(self.method, self.resource, self.host).encode()
 
+        if self.accept_encoding:
+            self.request += 'Accept-Encoding: {}\r\n'.format(self.accept_encoding).encode()
+
         request_body = None
 
         # Appends Content type and length to the header & reads the body.
         if self.method == "PUT" or self.method == "POST":
 
-            request_body = input("Please, enter string to send:\n").encode()
+            # Bodies from a file are not put in the request, but streamed by send.
+            if self.body_file is not None:
+                self.request += self.body_file_headers()
+                self.request += '\r\n'.encode()
+                return
+
+            if self.body is not None:
+                request_body = self.body
+            else:
+                request_body = input("Please, enter string to send:\n").encode()
 
 
             self.request += 'Content-Type: text/plain\r\nContent-Length: {}\r\n'.format(len(request_body)).encode()
 
-        # Appends the asked file to the body (if there is one)
+        # End of header
+        self.request += '\r\n'.encode()
+
+        # Appends the asked file to the body (if there is one). Nothing follows the body, so the next request on the
+        # connection starts right after it.
         if request_body:
-            self.request += '\r\n'.encode() + request_body
+            self.request += request_body
+
+    # Returns the size of body_file, or None if it is not known in advance (pipes, stdin from a terminal,...).
+    def body_file_size(self):
+        if self.body_file == "-":
+            fileno = sys.stdin.buffer.fileno()
+            if stat.S_ISREG(os.fstat(fileno).st_mode):
+                return os.fstat(fileno).st_size - sys.stdin.buffer.tell()
+            return None
+
+        if os.path.isfile(self.body_file):
+            return os.path.getsize(self.body_file)
+        return None
+
+    # Compiles the headers describing body_file. Without a known size, the body is sent chunked.
+    def body_file_headers(self):
+        content_type = None
+        if self.body_file != "-":
+            content_type = mimetypes.guess_type(self.body_file)[0]
+        headers = 'Content-Type: {}\r\n'.format(content_type or 'application/octet-stream')
+
+        self.body_size = self.body_file_size()
+        if self.body_size is None:
+            headers += 'Transfer-Encoding: chunked\r\n'
+        else:
+            headers += 'Content-Length: {}\r\n'.format(self.body_size)
 
-        # End of request
-        self.request += '\r\n'.encode()
+        if self.expect_continue:
+            headers += 'Expect: 100-continue\r\n'
+
+        return headers.encode()
+
+    # Sends the request. A body_file is streamed from disk: with sendfile if the size is known, chunked otherwise, so
+    # memory use does not depend on the size of the file. If the server answers before the body has been sent (after
+    # Expect: 100-continue), that final response is returned. Otherwise, returns None.
+    def send(self, connection, continue_timeout=1):
+        connection.sendall(self.request)
+
+        if self.body_file is None or self.method not in ("PUT", "POST"):
+            return None
+
+        # Wait for 100 Continue. If the server does not answer in time, send the body anyway.
+        if self.expect_continue:
+            if select.select([connection], [], [], continue_timeout)[0]:
+                response = Response(connection, interim=True)
+                if response.code != "100":
+                    return response
+
+        if self.body_file == "-":
+            f = sys.stdin.buffer
+        else:
+            f = open(self.body_file, "rb")
+
+        try:
+            if self.body_size is not None:
+                connection.sendfile(f, f.tell(), self.body_size)
+            else:
+                while True:
+                    block = f.read1(65536)
+                    if not block:
+                        break
+                    connection.sendall('{:x}\r\n'.format(len(block)).encode() + block + b'\r\n')
+                connection.sendall(b'0\r\n\r\n')
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+        return None
 
     # Used to change the resource of the request (for images)
     def change_resource(self, method, resource):
@@ -74,46 +177,100 @@ class Request:
 ##############################
 
 
-# Remove the data present on the socket
-def empty_socket(sock):
-    input = [sock]
-    while 1:
-        input_ready, o, e = select.select(input, [], [], 0.0)
-        if len(input_ready) == 0:
-            break
-        for s in input_ready: s.recv(1)
+# Class used to decompress a gzip or deflate body while it is being received.
+class ContentDecoder:
+
+    def __init__(self, coding):
+        self.coding = coding
+        self.decompressor = None
+        self.buffer = b""
+
+        if coding in ("gzip", "x-gzip"):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    # Returns the supported codings.
+    @staticmethod
+    def supports(coding):
+        return coding in ("gzip", "x-gzip", "deflate")
+
+    # Decompress a part of the body. Returns the decompressed data that is available.
+    def decompress(self, data):
+        # "deflate" should be zlib wrapped, but some servers send raw deflate. Decide when the first two bytes are in.
+        if self.decompressor is None:
+            self.buffer += data
+            if len(self.buffer) < 2:
+                return b""
+            is_zlib = self.buffer[0] & 0x0f == 8 and (self.buffer[0] << 8 | self.buffer[1]) % 31 == 0
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+            data, self.buffer = self.buffer, b""
+
+        return self.decompressor.decompress(data)
+
+    # Returns what is left in the decompressor at the end of the body.
+    def flush(self):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data, self.buffer = self.buffer, b""
+            return self.decompressor.decompress(data) + self.decompressor.flush()
+        return self.decompressor.flush()
 
 
 # Class used to receive and process the response.
 class Response:
 
     # Function to initiate all defaults and read the header. When header has been read, call the correct body receiver
-    # method (chunked or with content length)
-    def __init__(self, connection):
+    # method (chunked, with content length, or until the server closes the connection). If on_data is given, it is called with every part of the body as soon
+    # as it has been received. Responses to HEAD requests (is_head) never have a body. Interim (1xx) responses are
+    # skipped, unless interim is set.
+    def __init__(self, connection, on_data=None, is_head=False, interim=False):
         self.body = b""
         self.code = None
         self.encoding = "ISO-8859-1"
+        self.content_type = None
         self.content_length = None
+        self.content_encoding = None
+        self.body_length = 0
         self.is_chunked = False
+        self.keep_alive = True
+        self.on_data = on_data
+        self.decoders = []
+        self.first_byte = None
+        self.finished = None
 
         # Read and process header.
         self.header = self.receive_header(connection)
+        while self.code.startswith("1") and self.code != "101" and not interim:
+            self.header = self.receive_header(connection)
 
         # Call correct body method reader. If no body is expected, no one is called.
-        if self.is_chunked:
+        if is_head or self.code.startswith("1"):
+            self.keep_alive = "Connection: close" not in self.header
+        elif self.is_chunked:
             self.receive_chunked_body(connection)
         elif self.content_length is not None:
             self.receive_content_length_body(connection)
+        elif self.code not in ("204", "304"):
+            self.receive_until_close_body(connection)
+
+        # Process what is left in the decompressors.
+        self.receive_body_part(b"", True)
+        self.finished = time.perf_counter()
 
     # Function to receive header, and process interesting information.
     def receive_header(self, connection):
         data = bytes()
 
-        # Receive header, and decode
+        # Receive header, and decode. Blank lines in front of the status line (left behind by the previous response on
+        # this connection) are skipped.
         while b'\r\n\r\n' not in data:
             chunk = connection.recv(1)
             if not chunk: break
+            if self.first_byte is None: self.first_byte = time.perf_counter()
             data += chunk
+            if data == b'\r\n': data = bytes()
+
+        if b'\r\n\r\n' not in data:
+            raise ConnectionError("Connection closed before the response header was received")
 
         data = data.decode()
 
@@ -127,6 +284,7 @@ class Response:
         # Check all useful header fields
         for key in header_elements:
             if key == "Content-Type":
+                self.content_type = header_elements[key]
                 if "UTF-8" in header_elements[key]:
                     self.encoding = "UTF-8"
                 elif "ISO-8859-1" in header_elements[key]:
@@ -135,182 +293,942 @@ class Response:
                 self.content_length = int(header_elements[key])
             if key == "Transfer-Encoding":
                 self.is_chunked = True
+            if key == "Content-Encoding":
+                self.content_encoding = header_elements[key]
+            if key == "Connection" and header_elements[key].lower() == "close":
+                self.keep_alive = False
+
+        # Without a length, the body ends when the server closes the connection.
+        if not self.is_chunked and self.content_length is None and self.code not in ("204", "304"):
+            self.keep_alive = False
+
+        # Codings are applied in the order they are listed, so they are undone in reverse order. If one of them is not
+        # supported, the body is kept as it was received.
+        if self.content_encoding:
+            codings = [coding.strip().lower() for coding in self.content_encoding.split(",")]
+            codings = [coding for coding in codings if coding != "identity"]
+            if all(ContentDecoder.supports(coding) for coding in codings):
+                self.decoders = [ContentDecoder(coding) for coding in reversed(codings)]
 
         return data
 
+    # Function to process a part of the body. Decompresses it (if needed), stores it, and passes it on to on_data.
+    # At the end of the body, it is called once more with last set, to flush the decompressors.
+    def receive_body_part(self, part, last=False):
+        self.body_length += len(part)
+
+        for decoder in self.decoders:
+            part = decoder.decompress(part)
+            if last:
+                part += decoder.flush()
+
+        if not part:
+            return
+
+        self.body += part
+        if self.on_data:
+            self.on_data(self, part)
+
     # Function to receive chunked bodies.
     def receive_chunked_body(self, connection):
         while True:
             # Get length of the next chunk
             length = bytes()
             while b'\r\n' not in length:
-                length += connection.recv(1)
+                chunk = connection.recv(1)
+                if not chunk:
+                    raise ConnectionError("Connection closed in the middle of a chunked body")
+                length += chunk
             length = int(length.decode(self.encoding), 16)
             
             # If last chunk has been read, return. Otherwise, read content of chunk
             if length == 0:
                 connection.recv(2)
                 return
-            remaining = length + 2  # +2 for \r\n
+            remaining = length
 
             # Read chunk
-            chunk = b''
             while remaining > 0:
                 if remaining > 1024:
                     part = connection.recv(1024)
                 else:
                     part = connection.recv(remaining)
+                if not part:
+                    raise ConnectionError("Connection closed in the middle of a chunked body")
 
-                chunk += part
+                self.receive_body_part(part)
                 remaining -= len(part)
-                
-            self.body += chunk
+
+            # Read the \r\n behind the chunk
+            remaining = 2
+            while remaining > 0:
+                remaining -= len(connection.recv(remaining))
 
     # Function to receive a body with content_length. Receives in chunks of 1024 by default, until there is less than
     # 1024 bytes of data left.
     def receive_content_length_body(self, connection, chunk_size = 1024):
-        data = bytes()
-
         length = self.content_length
         while length > 0:
             if length > chunk_size:
                 part = connection.recv(chunk_size)
             else:
                 part = connection.recv(length)
-            data += part
+            if not part: break
+            self.receive_body_part(part)
             length -= len(part)
 
-        self.body = data
-        empty_socket(connection)
+    # Function to receive a body without length: it ends when the server closes the connection.
+    def receive_until_close_body(self, connection, chunk_size = 1024):
+        while True:
+            part = connection.recv(chunk_size)
+            if not part: break
+            self.receive_body_part(part)
 
 ##############################
 
 
-# Function to import the images from a HTML file. Uses BeautifulSoup to parse the HTML. The folder structure remains almost
-# the same as on the server. No support for external images.
-def import_images(connection, request, response):
-    soup = BeautifulSoup(response.body.decode(response.encoding), "html.parser")
-
-    # Find all images
-    images = soup.findAll('img')
+# Checks if an asset is hosted on another server than the page it is on. src is resolved against base, the URL of the
+# page, so relative and protocol relative (//host/...) URLs are classified correctly.
+def is_external(src, base="/"):
+    target, page = urlparse(urljoin(base, src)), urlparse(base)
+    return bool(target.netloc) and (target.hostname, target.port or 80) != (page.hostname, page.port or 80)
 
-    external_image = []
-    # Send a GET request to get all images.
-    for image in images:
-        src = image['src']
 
-        if "http" in src or "www" in src:
-            external_image.append(image)
-        else:
-            if src[0] != "/":
-                src = "/" + src
+# Returns the path (relative to the output folder) under which an asset is saved. The folder structure remains almost
+# the same as on the server: the scheme, host and query are dropped. The path is normalized, so it never points
+# outside of the output folder.
+def local_name(src):
+    path = urlparse(src).path
+    name = posixpath.normpath("/" + path).lstrip("/")
+    if not name or path.endswith("/"):
+        name = posixpath.join(name, "index.html")
 
-            request.change_resource("GET", src)
+    return name
 
-            # Send request
-            print("[SENDING]\n" + request.request.decode())
-            connection.sendall(request.request)
 
-            # Receive response
-            response = Response(connection)
-            print("[RECEIVED]\n" + response.header)
+# Opens a connection to the given host and port. If timings is given, the moments the DNS lookup and the connect
+# finished are stored in it.
+def open_connection(host, port, timeout=None, timings=None):
+    ip = socket.gethostbyname(host)
+    if timings is not None: timings["dns"] = time.perf_counter()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect((ip, int(port)))
+    if timings is not None: timings["connect"] = time.perf_counter()
+    return sock
 
-            # Check if directories exists. If not, create it.
-            directory = "output" + os.path.dirname(src)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
 
-            with open("output/" + src, "wb") as out:
-                out.write(response.body)
-                out.close()
+# Writes a received asset to the output folder. Creates the directories if they do not exist.
+def save_asset(src, body):
+    directory = os.path.dirname("output/" + src)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
-            if src[0] == "/": src = src[1:]
-            image['src'] = src
+    with open("output/" + src, "wb") as out:
+        out.write(body)
+        out.close()
 
-    # Do the same as above, but with lowsrc.
-    for image in images:
-        if image.has_attr("lowsrc"):
-            src = image['lowsrc']
 
-            if src[0] != "/":
-                src = "/" + src
+# Class used to find the assets (images, stylesheets and scripts) in a HTML file while it is being received. It is fed
+# the body part by part, calls on_asset as soon as an asset URL is found, and rebuilds the document with the URLs
+# rewritten to the local copies. Relative asset URLs are resolved against base, the URL (or resource) of the document.
+class AssetExtractor(HTMLParser):
+
+    def __init__(self, on_asset, on_link=None, base="/"):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.on_asset = on_asset
+        self.on_link = on_link
+        self.base = base
+        self.seen = set()
+        self.output = []
+        self.decoder = None
+
+    # Feed a part of the body. Parts are decoded incrementally, so multi-byte characters may be split between parts.
+    def feed_bytes(self, data, encoding):
+        if self.decoder is None:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.feed(self.decoder.decode(data))
+
+    # Process everything that is still buffered.
+    def close(self):
+        if self.decoder is not None:
+            self.feed(self.decoder.decode(b"", final=True))
+        HTMLParser.close(self)
+
+    # Returns the rewritten document.
+    def html(self):
+        return "".join(self.output)
+
+    # Returns the attributes of a tag that point to an asset.
+    def asset_attributes(self, tag, attrs):
+        if tag == "img":
+            return ("src", "lowsrc", "srcset")
+        if tag == "source":
+            return ("src", "srcset")
+        if tag == "script":
+            return ("src",)
+        if tag == "link" and "stylesheet" in (dict(attrs).get("rel") or "").lower():
+            return ("href",)
+        return ()
+
+    # Announce an asset, and return the URL it should be replaced with. Assets on this server are announced with their
+    # resolved resource, and external assets with their absolute http:// URL, so an asset is announced (and saved)
+    # once, however its URL is written. Assets that can not be fetched over http (https:, data:,...) are left alone.
+    def asset(self, src):
+        src = src.strip()
+        if not src or src.startswith("#"):
+            return src
+
+        try:
+            target = urlparse(urljoin(self.base, urldefrag(src)[0]))
+            external = is_external(target.geturl(), self.base)
+        except ValueError:
+            return src
+        if target.scheme not in ("", "http"):
+            return src
+
+        if external:
+            src = target._replace(scheme="http").geturl()
+        else:
+            resolved = posixpath.normpath("/" + target.path.lstrip("/"))
+            if target.path.endswith("/") and resolved != "/":
+                resolved += "/"
+            src = resolved + ("?" + target.query if target.query else "")
+
+        if src not in self.seen:
+            self.seen.add(src)
+            self.on_asset(src)
+
+        return local_name(src)
+
+    # srcset holds a comma separated list of "URL [descriptor]" candidates.
+    def asset_srcset(self, srcset):
+        candidates = []
+        for candidate in srcset.split(","):
+            parts = candidate.split(None, 1)
+            if parts:
+                parts[0] = self.asset(parts[0])
+                candidates.append(" ".join(parts))
+        return ", ".join(candidates)
+
+    # Rebuild a start tag. Tags without assets are copied as they were.
+    def rewrite_tag(self, tag, attrs, closed):
+        names = self.asset_attributes(tag, attrs)
+        if not any(name in names and value for name, value in attrs):
+            return self.get_starttag_text()
+
+        text = "<" + tag
+        for name, value in attrs:
+            if value is None:
+                text += " " + name
+                continue
+            if name in names:
+                value = self.asset_srcset(value) if name == "srcset" else self.asset(value)
+            text += ' {}="{}"'.format(name, html.escape(value))
+
+        return text + (" />" if closed else ">")
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a" and self.on_link:
+            href = dict(attrs).get("href")
+            if href:
+                self.on_link(href)
+        self.output.append(self.rewrite_tag(tag, attrs, False))
+
+    def handle_startendtag(self, tag, attrs):
+        self.output.append(self.rewrite_tag(tag, attrs, True))
+
+    def handle_endtag(self, tag):
+        self.output.append("</{}>".format(tag))
+
+    def handle_data(self, data):
+        self.output.append(data)
+
+    def handle_entityref(self, name):
+        self.output.append("&{};".format(name))
+
+    def handle_charref(self, name):
+        self.output.append("&#{};".format(name))
+
+    def handle_comment(self, data):
+        self.output.append("<!--{}-->".format(data))
+
+    def handle_decl(self, decl):
+        self.output.append("<!{}>".format(decl))
+
+    def handle_pi(self, data):
+        self.output.append("<?{}>".format(data))
+
+    def unknown_decl(self, data):
+        self.output.append("<![{}]>".format(data))
+
+
+# Class used to record the timing of every fetched resource: DNS lookup, connect, request write, time to first byte
+# and download, plus the sizes. All moments are taken with perf_counter. The results can be written as a HAR file,
+# or printed as a waterfall.
+class HarRecorder:
+
+    def __init__(self):
+        # Used to turn perf_counter moments into wall clock times.
+        self.wall = time.time()
+        self.perf = time.perf_counter()
+        self.entries = []
+
+    # Sends the request, and records it. timings holds the moments of the earlier phases ("start", and "dns" and
+    # "connect" if a connection was opened for it). Returns the entry (to pass to received) and the early response of
+    # Request.send.
+    def send(self, request, connection, timings=None):
+        if timings is None:
+            timings = {"start": time.perf_counter()}
+
+        timings["send_start"] = time.perf_counter()
+        early_response = request.send(connection)
+        timings["send_end"] = time.perf_counter()
+
+        header, _, body = request.request.partition(b"\r\n\r\n")
+        if request.body_file is not None:
+            body_size = getattr(request, "body_size", None)
+            if body_size is None:
+                body_size = -1
+        else:
+            body_size = len(body)
+
+        entry = {
+            "method": request.method,
+            "url": "http://{}:{}{}".format(request.host, request.port, request.resource),
+            "header": header.decode(),
+            "body_size": body_size,
+            "timings": timings,
+            "response": None,
+        }
+        self.entries.append(entry)
+
+        return entry, early_response
+
+    # Records the response to a request.
+    def received(self, entry, response):
+        entry["response"] = response
+
+    # Returns the phases of an entry in milliseconds, as in a HAR file (-1 for phases that did not happen).
+    def phases(self, entry):
+        timings = entry["timings"]
+        response = entry["response"]
+
+        def ms(start, end):
+            return max(0.0, (end - start) * 1000)
+
+        phases = {"blocked": -1, "dns": -1, "connect": -1, "ssl": -1}
+        if "dns" in timings:
+            phases["dns"] = ms(timings["start"], timings["dns"])
+            phases["connect"] = ms(timings["dns"], timings["connect"])
+        phases["send"] = ms(timings["send_start"], timings["send_end"])
+        phases["wait"] = ms(timings["send_end"], response.first_byte or response.finished)
+        phases["receive"] = ms(response.first_byte or response.finished, response.finished)
+        return phases
+
+    # Returns the recorded entries as a HAR log.
+    def har(self):
+        entries = []
+        for entry in self.entries:
+            response = entry["response"]
+            if response is None:
+                continue
+            phases = self.phases(entry)
+
+            started = self.wall + entry["timings"]["start"] - self.perf
+            request_lines = entry["header"].split("\r\n")
+            response_lines = response.header.split("\r\n")
+            status_line = response_lines[0].split(" ", 2)
+
+            entries.append({
+                "startedDateTime": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+                "time": sum(value for value in phases.values() if value > 0),
+                "request": {
+                    "method": entry["method"],
+                    "url": entry["url"],
+                    "httpVersion": "HTTP/1.1",
+                    "headers": har_headers(request_lines[1:]),
+                    "queryString": [],
+                    "cookies": [],
+                    "headersSize": len(entry["header"]) + 4,
+                    "bodySize": entry["body_size"],
+                },
+                "response": {
+                    "status": int(response.code),
+                    "statusText": status_line[2] if len(status_line) > 2 else "",
+                    "httpVersion": status_line[0],
+                    "headers": har_headers(response_lines[1:]),
+                    "cookies": [],
+                    "content": {
+                        "size": len(response.body),
+                        "compression": len(response.body) - response.body_length,
+                        "mimeType": response.content_type or "",
+                    },
+                    "redirectURL": "",
+                    "headersSize": len(response.header),
+                    "bodySize": response.body_length,
+                },
+                "cache": {},
+                "timings": phases,
+            })
+
+        return {"log": {"version": "1.2", "creator": {"name": "client.py", "version": "1.0"}, "entries": entries}}
+
+    # Writes the HAR log to a file.
+    def write(self, filename):
+        with open(filename, "w") as out:
+            json.dump(self.har(), out, indent=2)
+            out.close()
 
-            request.change_resource("GET", src)
+    # Prints a waterfall: one line per resource, with its phases drawn on a common time axis (d = DNS, c = connect,
+    # s = send, w = wait, r = receive).
+    def print_waterfall(self, width=50):
+        entries = [entry for entry in self.entries if entry["response"] is not None]
+        if not entries:
+            return
 
-            # Send request
-            print("[SENDING]\n" + request.request.decode())
-            connection.sendall(request.request)
+        origin = min(entry["timings"]["start"] for entry in entries)
+        end = max(entry["response"].finished for entry in entries)
+        scale = width / max(end - origin, 1e-9) / 1000
 
-            # Receive response
-            response = Response(connection)
+        print("[WATERFALL] d = DNS, c = connect, s = send, w = wait, r = receive")
+        for entry in entries:
+            phases = self.phases(entry)
+            bar = " " * int((entry["timings"]["start"] - origin) * 1000 * scale)
+            for phase in ("dns", "connect", "send", "wait", "receive"):
+                if phases[phase] > 0:
+                    bar += phase[0] * max(1, int(phases[phase] * scale))
+            total = sum(value for value in phases.values() if value > 0)
+
+            print("{:<{}} {:8.2f}ms {:>3} {:>9}B  {}".format(bar[:width + 5], width + 5, total, entry["response"].code,
+                                                          entry["response"].body_length, entry["url"]))
+
+
+# Changes header lines to HAR name/value pairs.
+def har_headers(lines):
+    return [{"name": k, "value": v.strip()} for k, v in [line.split(":", 1) for line in lines if ":" in line]]
+
+
+# Class used to import the assets of a HTML file. The HTML body is parsed while it is being received: assets on the
+# same server are requested right away (pipelined on the same connection), external assets are fetched afterwards.
+class AssetImporter:
+
+    def __init__(self, connection, request, har):
+        self.connection = connection
+        self.request = request
+        self.har = har
+        self.base = "http://{}:{}{}".format(request.host, request.port, request.resource)
+        self.extractor = AssetExtractor(self.request_asset, base=self.base)
+        self.is_html = False
+        self.keep_alive = True
+        self.pending = []
+        self.external = []
+
+    # Passed to Response as on_data. Only successful HTML bodies are parsed.
+    def feed(self, response, part):
+        if not self.is_html:
+            if int(response.code) != 200 or "html" not in (response.content_type or "text/html"):
+                return
+            self.is_html = True
+            self.keep_alive = response.keep_alive
+        self.extractor.feed_bytes(part, response.encoding)
+
+    # Called by the extractor for every asset (with its resolved resource). Assets on this server are requested
+    # immediately, unless the server closes the connection after the document. pending holds the requested assets with
+    # their HAR entry (None if the request was not sent).
+    def request_asset(self, src):
+        if is_external(src, self.base):
+            self.external.append(src)
+            return
+
+        if not self.keep_alive:
+            self.pending.append((src, None))
+            return
+
+        self.request.change_resource("GET", src)
+
+        # Send request. If the server already closed the connection, it is sent again by resend.
+        print("[SENDING]\n" + self.request.request.decode())
+        try:
+            entry, _ = self.har.send(self.request, self.connection)
+        except OSError:
+            entry = None
+        self.pending.append((src, entry))
+
+    # Open a new connection, and send the requests that were not answered yet on it.
+    def resend(self):
+        self.connection.close()
+
+        timings = {"start": time.perf_counter()}
+        self.connection = open_connection(self.request.host, self.request.port, TIMEOUT, timings)
+
+        pending, self.pending = self.pending, []
+        for src, _ in pending:
+            self.request.change_resource("GET", src)
+            print("[SENDING]\n" + self.request.request.decode())
+            try:
+                entry, _ = self.har.send(self.request, self.connection, timings)
+            except OSError:
+                entry = None
+            self.pending.append((src, entry))
+            timings = None
+
+    # Receive the responses of the requested assets, fetch the external ones, and write the HTML to
+    # output/output.html
+    def import_assets(self):
+        if not self.is_html:
+            self.connection.close()
+            return
+
+        self.extractor.close()
+
+        # Receive the pipelined responses, in the order they were requested. When the server closes the connection,
+        # the requests it did not answer are sent again on a new connection. If that one is closed before answering
+        # anything, the remaining assets are given up.
+        answered = True
+        while self.pending:
+            src, entry = self.pending[0]
+            try:
+                if entry is None:
+                    raise ConnectionError("The request could not be sent")
+                response = Response(self.connection)
+            except ConnectionError as e:
+                if not answered:
+                    print("[FAILED]", len(self.pending), "assets were not received:", e)
+                    break
+                self.resend()
+                answered = False
+                continue
+
+            self.pending.pop(0)
+            answered = True
+            self.har.received(entry, response)
             print("[RECEIVED]\n" + response.header)
+            save_asset(local_name(src), response.body)
+
+            if not response.keep_alive and self.pending:
+                self.resend()
+                answered = False
+
+        self.connection.close()
+
+        # Fetch the external assets. An asset that can not be fetched is skipped, so the document is still written.
+        for src in self.external:
+            sock = None
+            try:
+                # Make a request
+                host, port, resource = split_url(src)
+                request = Request(["GET", host + resource, port])
+
+                # Initiate socket connection
+                timings = {"start": time.perf_counter()}
+                sock = open_connection(request.host, request.port, TIMEOUT, timings)
+
+                # Send Request
+                print("[SENDING]\n" + request.request.decode())
+                entry, _ = self.har.send(request, sock, timings)
+
+                # Receive response
+                response = Response(sock)
+                self.har.received(entry, response)
+                print("[RECEIVED]\n" + response.header)
+                save_asset(local_name(src), response.body)
+            except Exception as e:
+                print("[FAILED]", src, e)
+            finally:
+                if sock:
+                    sock.close()
+
+        # Write html to output/output.html
+        with open("output/output.html", "w") as out:
+            out.write(self.extractor.html())
+            out.close()
 
-            directory = "output" + os.path.dirname(src)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+##############################
 
-            # Write to file
-            with open("output/" + src, "wb") as out:
-                out.write(response.body)
-                out.close()
 
-            if src[0] == "/": src = src[1:]
-            image['src'] = src
+# Splits an URL into host, port and resource.
+def split_url(url):
+    if "://" not in url:
+        url = "http://" + url
+    parsed = urlparse(url)
 
-    connection.close()
+    resource = parsed.path or "/"
+    if parsed.query:
+        resource += "?" + parsed.query
 
-    for image in external_image:
-        src = image['src']
+    return parsed.hostname, parsed.port or 80, resource
 
-        if "http://" in src:
-            src = src[7:]
 
-        # Make a request
-        request = Request(["GET",src])
-        src = request.resource
-        if src[0] != "/":
-            src = "/" + src
+# Returns the path (relative to the output folder) under which a mirrored resource is saved: one folder per host,
+# with the folder structure of the server below it.
+def mirror_name(host, port, resource):
+    path = posixpath.normpath("/" + resource.split("?")[0])
+    if resource.split("?")[0].endswith("/"):
+        path = path.rstrip("/") + "/index.html"
 
-        # Initiate socket connection
-        ip = socket.gethostbyname(request.host)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((ip, int(request.port)))
+    if int(port) != 80:
+        host = "{}_{}".format(host, port)
 
-        # Send Request
-        print("[SENDING]\n" + request.request.decode())
-        sock.sendall(request.request)
+    return host + path
 
-        # Receive response
-        response = Response(sock)
-        print("[RECEIVED]\n" + response.header)
 
-        # Check if directories exists. If not, create it.
-        directory = "output" + os.path.dirname(src)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+# Class used to keep connections open between requests. Idle connections are kept per (host, port), and are shared
+# between all threads.
+class ConnectionPool:
 
-        with open("output/" + src, "wb") as out:
-            out.write(response.body)
-            out.close()
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
 
-        if src[0] == "/": src = src[1:]
-        image['src'] = src
+    # Returns an idle connection if there is one, otherwise opens a new one. Also returns whether it was reused.
+    def get(self, host, port):
+        with self.lock:
+            connections = self.idle.get((host, port))
+            if connections:
+                return connections.pop(), True
 
-        sock.close()
+        return open_connection(host, port, self.timeout), False
 
-    # Write html to output/output.html
-    with open("output/output.html", "w") as out:
-        out.write(str(soup))
-        out.close()
+    # Gives a connection back, so it can be reused.
+    def put(self, host, port, connection):
+        with self.lock:
+            self.idle.setdefault((host, port), []).append(connection)
 
-##############################
+    # Sends the request and returns the response. If a reused connection has been closed by the server in the
+    # meantime, the request is sent again.
+    def fetch(self, request):
+        while True:
+            connection, reused = self.get(request.host, request.port)
+            try:
+                connection.sendall(request.request)
+                response = Response(connection)
+            except Exception:
+                connection.close()
+                if reused:
+                    continue
+                raise
+
+            if response.keep_alive:
+                self.put(request.host, request.port, connection)
+            else:
+                connection.close()
+
+            return response
+
+    # Close all idle connections.
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+# Class used to limit the requests per host: at most concurrency requests at the same time, and (if rate is given) at
+# most rate requests per second.
+class HostLimits:
+
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.interval = 1 / rate if rate else 0
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    # Wait until a request to host may be sent. Use as: with limits.slot(host): ...
+    @contextmanager
+    def slot(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.Semaphore(self.concurrency), 0.0]
+            limit = self.hosts[host]
+
+        limit[0].acquire()
+        try:
+            # Reserve the next free moment for this host.
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, limit[1])
+                limit[1] = start + self.interval
+            time.sleep(start - now)
+
+            yield
+        finally:
+            limit[0].release()
+
+
+# Class used to mirror a list of URLs into the output folder. Pages are parsed for assets and <a href> links on the same
+# host, which are mirrored as well as long as the link depth is not exceeded. Every URL is fetched only once.
+class Crawler:
+
+    def __init__(self, depth=0, workers=4, per_host=2, rate=0):
+        self.depth = depth
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.visited = set()
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool()
+        self.limits = HostLimits(per_host, rate)
+
+    # Add an URL to the work queue, unless it has been visited before.
+    def add(self, url, depth):
+        url = urldefrag(url)[0]
+        with self.lock:
+            if url in self.visited:
+                return
+            self.visited.add(url)
 
+        self.queue.put((url, depth))
 
-def main(list):
-    if len(list) < 2:
+    # Mirror all URLs (and the pages they link to). Returns when the work queue is empty.
+    def run(self, urls):
+        for url in urls:
+            self.add(url if "://" in url else "http://" + url, 0)
+
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+        self.queue.join()
+        self.pool.close()
+
+    # Worker thread: takes URLs from the work queue until the program ends.
+    def work(self):
+        while True:
+            url, depth = self.queue.get()
+            try:
+                self.mirror(url, depth)
+            except Exception as e:
+                print("[FAILED]", url, e)
+            finally:
+                self.queue.task_done()
+
+    # Fetch an URL, save it, and add the assets and links it contains to the work queue.
+    def mirror(self, url, depth):
+        host, port, resource = split_url(url)
+        request = Request(["GET", host + resource, port])
+
+        with self.limits.slot((host, port)):
+            response = self.pool.fetch(request)
+
+        print("[MIRRORED]", response.code, url)
+        if int(response.code) != 200:
+            return
+
+        save_asset(mirror_name(host, port, resource), response.body)
+
+        if "html" not in (response.content_type or "text/html"):
+            return
+
+        # Only follow assets and links on the same host.
+        def same_host(src, link_depth):
+            target = urljoin(url, src)
+            if urlparse(target).netloc == urlparse(url).netloc:
+                self.add(target, link_depth)
+
+        def on_link(href):
+            if depth < self.depth:
+                same_host(href, depth + 1)
+
+        extractor = AssetExtractor(lambda src: same_host(src, depth), on_link, resource)
+        extractor.feed_bytes(response.body, response.encoding)
+        extractor.close()
+
+
+# Class used to benchmark a server. Opens a number of keep-alive connections, and replays a mix of requests on each of
+# them (pipelined if pipeline > 1) for a fixed duration or number of requests.
+class LoadGenerator:
+
+    def __init__(self, url, connections=10, pipeline=1, mix=None, duration=None, requests=None, body_size=64,
+                 upload_path="/loadtest.txt", timeout=10):
+        self.host, self.port, self.resource = split_url(url)
+        self.connections = connections
+        self.pipeline = pipeline
+        self.mix = mix or {"GET": 1}
+        self.duration = duration if duration is not None or requests is not None else 10
+        self.limit = requests
+        self.timeout = timeout
+        self.issued = 0
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        # Compile every request once.
+        body = b"x" * body_size
+        self.requests = {}
+        for method in self.mix:
+            resource = upload_path if method in ("PUT", "POST") else self.resource
+            request = Request([method, self.host + resource, self.port], body)
+            self.requests[method] = request.request
+
+    # Reserve up to n requests. Returns how many may still be sent.
+    def reserve(self, n):
+        with self.lock:
+            if self.limit is None:
+                return n
+            n = min(n, self.limit - self.issued)
+            self.issued += n
+            return n
+
+    # Count the requests that got no response because of error.
+    def count_error(self, error, count=1):
+        with self.lock:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + count
+
+    # Run the benchmark, and return the results.
+    def run(self):
+        self.start = time.monotonic()
+        self.deadline = self.start + self.duration if self.duration is not None else None
+
+        threads = [threading.Thread(target=self.work) for _ in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.results(time.monotonic() - self.start)
+
+    # Worker thread: one connection. Sends pipeline requests at once, then reads the responses in order. The connection
+    # is opened again when the server closes it or an error occurs.
+    def work(self):
+        methods = list(self.mix)
+        weights = [self.mix[method] for method in methods]
+        connection = None
+        latencies = []
+        status_codes = {}
+        sent = received = 0
+
+        while self.deadline is None or time.monotonic() < self.deadline:
+            n = self.reserve(self.pipeline)
+            if n <= 0:
+                break
+
+            batch = random.choices(methods, weights, k=n)
+            answered = 0
+            try:
+                if connection is None:
+                    connection = open_connection(self.host, self.port, self.timeout)
+
+                data = b"".join(self.requests[method] for method in batch)
+                started = time.monotonic()
+                connection.sendall(data)
+                sent += len(data)
+
+                keep_alive = True
+                for method in batch:
+                    response = Response(connection, is_head=method == "HEAD")
+                    latencies.append(time.monotonic() - started)
+                    status_codes[response.code] = status_codes.get(response.code, 0) + 1
+                    received += len(response.header) + response.body_length
+                    keep_alive = keep_alive and response.keep_alive
+                    answered += 1
+
+                if not keep_alive:
+                    connection.close()
+                    connection = None
+            except Exception as e:
+                self.count_error(e, n - answered)
+                if connection is not None:
+                    connection.close()
+                    connection = None
+
+        if connection is not None:
+            connection.close()
+
+        # Merge the results of this worker.
+        with self.lock:
+            self.latencies += latencies
+            for code in status_codes:
+                self.status_codes[code] = self.status_codes.get(code, 0) + status_codes[code]
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    # Collect the results in a dict, with the latencies in milliseconds.
+    def results(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+        return {
+            "url": "http://{}:{}{}".format(self.host, self.port, self.resource),
+            "connections": self.connections,
+            "pipeline": self.pipeline,
+            "mix": self.mix,
+            "elapsed": elapsed,
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed if elapsed else 0,
+            "latency": {
+                "min": latencies[0] * 1000 if latencies else None,
+                "mean": sum(latencies) / len(latencies) * 1000 if latencies else None,
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "p999": percentile(99.9),
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+            "status_codes": self.status_codes,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+# Parses a request mix such as "GET=8,HEAD=1,PUT=1" into a dict of weights.
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        method, _, weight = part.partition("=")
+        weights[method.strip().upper()] = float(weight) if weight else 1.0
+    return weights
+
+
+# Load mode: benchmark the server at the given URL, and print the results.
+def load(list):
+    parser = argparse.ArgumentParser(prog="client.py")
+    parser.add_argument("--load", metavar="URL", required=True, help="URL to benchmark")
+    parser.add_argument("--connections", type=int, default=10, help="number of concurrent connections")
+    parser.add_argument("--pipeline", type=int, default=1, help="number of requests sent at once per connection")
+    parser.add_argument("--mix", default="GET=1", help="request mix, for example GET=8,HEAD=1,PUT=1")
+    parser.add_argument("--duration", type=float, help="duration of the benchmark in seconds (default 10)")
+    parser.add_argument("--requests", type=int, help="total number of requests to send")
+    parser.add_argument("--body-size", type=int, default=64, help="body size of PUT and POST requests")
+    parser.add_argument("--upload-path", default="/loadtest.txt", help="resource to send PUT and POST requests to")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE (- for stdout)")
+    args = parser.parse_args(list)
+
+    generator = LoadGenerator(args.load, args.connections, args.pipeline, parse_mix(args.mix), args.duration,
+                              args.requests, args.body_size, args.upload_path)
+    results = generator.run()
+
+    if args.json == "-":
+        print(json.dumps(results, indent=2))
         return
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+            out.close()
+
+    print("Requests:    {} in {:.2f}s ({:.1f} req/s)".format(results["requests"], results["elapsed"],
+                                                             results["throughput"]))
+    if results["requests"]:
+        print("Latency:     " + ", ".join("{} {:.2f}ms".format(k, v) for k, v in results["latency"].items()))
+    print("Status:      " + ", ".join("{}: {}".format(k, v) for k, v in sorted(results["status_codes"].items())))
+    print("Errors:      " + (", ".join("{}: {}".format(k, v) for k, v in results["errors"].items()) or "none"))
+    print("Transferred: {} bytes sent, {} bytes received".format(results["bytes_sent"], results["bytes_received"]))
+
+
+# Remove everything in the output folder.
+def clean_output():
+    if not os.path.exists("output"):
+        os.makedirs("output")
 
-    # Clean the output folder
     with os.scandir("output") as entries:
         for entry in entries:
             if entry.is_file():
@@ -318,27 +1236,88 @@ def main(list):
             elif entry.is_dir():
                 shutil.rmtree(entry.path)
 
+
+# Batch mode: mirror a list of URLs (--batch) or a site (--crawl) into the output folder, using one connection pool.
+def batch(list):
+    parser = argparse.ArgumentParser(prog="client.py")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--batch", metavar="FILE", help="file with one URL per line")
+    source.add_argument("--crawl", metavar="URL", help="seed URL to start crawling from")
+    parser.add_argument("--depth", type=int, default=0, help="how many levels of <a href> links to follow")
+    parser.add_argument("--workers", type=int, default=4, help="number of requests in flight")
+    parser.add_argument("--per-host", type=int, default=2, help="maximum number of requests in flight per host")
+    parser.add_argument("--rate", type=float, default=0, help="maximum number of requests per second per host")
+    args = parser.parse_args(list)
+
+    if args.batch:
+        with open(args.batch) as f:
+            urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    else:
+        urls = [args.crawl]
+
+    clean_output()
+
+    crawler = Crawler(args.depth, args.workers, args.per_host, args.rate)
+    crawler.run(urls)
+
+
+def main(list):
+    if list and list[0] in ("--batch", "--crawl"):
+        batch(list)
+        return
+
+    if list and list[0] == "--load":
+        load(list)
+        return
+
+    parser = argparse.ArgumentParser(prog="client.py")
+    parser.add_argument("method", help="GET, HEAD, PUT or POST")
+    parser.add_argument("url", help="URL to request")
+    parser.add_argument("port", nargs="?", default=80, help="port of the server (default 80)")
+    parser.add_argument("--file", metavar="PATH", help="stream the body of a PUT or POST from PATH (- for stdin)")
+    parser.add_argument("--expect-continue", action="store_true",
+                        help="wait for the server to accept the request before sending the body")
+    parser.add_argument("--har", metavar="FILE", help="write the timing of every fetched resource to FILE")
+    args = parser.parse_args(list)
+
+    if args.file is not None and args.method not in ("PUT", "POST"):
+        parser.error("--file can only be used with PUT and POST")
+
+    # Clean the output folder
+    clean_output()
+
+    har = HarRecorder()
+
     # Make a request
-    request = Request(list)
+    request = Request([args.method, args.url, args.port], body_file=args.file, expect_continue=args.expect_continue)
 
     # Initiate socket connection
-    ip = socket.gethostbyname(request.host)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((ip, int(request.port)))
+    timings = {"start": time.perf_counter()}
+    sock = open_connection(request.host, request.port, TIMEOUT, timings)
 
     # Send Request
     print("[SENDING]\n" + request.request.decode())
-    sock.sendall(request.request)
-
-    # Receive response
-    response = Response(sock)
-    print("[RECEIVED]\n" + response.header)
+    entry, early_response = har.send(request, sock, timings)
+
+    # Receive response. For GET, the HTML is parsed while it is being received, so the assets can be requested before
+    # the document is complete.
+    if request.method == "GET":
+        importer = AssetImporter(sock, request, har)
+        response = Response(sock, importer.feed)
+        har.received(entry, response)
+        print("[RECEIVED]\n" + response.header)
 
-    # If method is GET and everything happened as intended, get images.
-    if request.method == "GET" and int(response.code) == 200:
-        import_images(sock, request, response)
+        # If everything happened as intended, get assets.
+        importer.import_assets()
     else:
+        response = early_response or Response(sock)
+        har.received(entry, response)
+        print("[RECEIVED]\n" + response.header)
         sock.close()
 
+    har.print_waterfall()
+    if args.har:
+        har.write(args.har)
+
 if __name__ == '__main__':
     main(sys.argv[1:])
\ No newline at end of file
@@ -1,9 +1,15 @@
+import argparse
+import cProfile
+import hashlib
+import math
 import mimetypes
 import os
-import select
+import random
 import socket
+import string
 import sys
 import threading
+import tracemalloc
 from datetime import datetime
 import time
 from urllib.parse import urlparse
@@ -12,45 +18,130 @@ from urllib.parse import urlparse
 ##############################
 
 
-# Remove the data present on the socket
-def empty_socket(sock):
-    input = [sock]
-    while 1:
-        inputready, o, e = select.select(input, [], [], 0.0)
-        if len(inputready) == 0: break
-        for s in inputready: s.recv(1)
+# Raised by Separator when a request exceeds the limits. Holds the status code to answer with.
+class LimitExceeded(Exception):
+    def __init__(self, status_code):
+        Exception.__init__(self, status_code)
+        self.status_code = status_code
+
+
+# Raised when admission control refuses a request. Answered with 503 and a Retry-After of retry_after seconds.
+class Refused(Exception):
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+
+# Raised by Separator when a request is malformed (invalid Content-Length or chunk size). Answered with 400.
+class InvalidRequest(Exception):
+    status_code = 400
+
+
+# Class holding the size limits of requests. Bodies are also limited by a memory budget, shared by all connections:
+# the sum of the bodies held in memory at the same time never exceeds memory_budget.
+class Limits:
+    def __init__(self, max_request_line=8192, max_header=65536, max_body=64 * 1024 * 1024,
+                 memory_budget=256 * 1024 * 1024):
+        self.max_request_line = max_request_line
+        self.max_header = max_header
+        self.max_body = max_body
+        self.memory_budget = memory_budget
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    # Reserve memory for a body. Returns False if the budget does not allow it.
+    def reserve(self, size):
+        with self.lock:
+            if self.in_flight + size > self.memory_budget:
+                return False
+            self.in_flight += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.in_flight -= size
 
 
 # Class used to receive and separate the header from the body.
 class Separator:
     # Function to initiate all defaults and read the header. When header has been read, call the correct body receiver
-    # method (chunked or with content length)
-    def __init__(self, connection):
+    # method (chunked or with content length). If limits are given, LimitExceeded is raised as soon as the request
+    # exceeds them, before the data is buffered. The memory reserved for the body must be given back with release.
+    # on_header is called when the header has been read, before the body is. It can refuse the request by raising.
+    def __init__(self, connection, limits=None, on_header=None):
         self.body = b""
         self.code = None
         self.encoding = "ISO-8859-1"
         self.content_length = None
         self.is_chunked = False
-
-        # Read and process header.
-        self.header = self.receive_header(connection)
-
-        # Call correct body method reader. If no body is expected, no one is called.
-        if self.is_chunked:
-            self.receive_chunked_body(connection)
-        elif self.content_length is not None:
-            self.receive_content_length_body(connection)
+        self.expect_continue = False
+        self.first_byte = None
+        self.limits = limits
+        self.reserved = 0
+
+        try:
+            # Read and process header.
+            self.header = self.receive_header(connection)
+            if on_header:
+                on_header(self)
+
+            # Call correct body method reader. If no body is expected, no one is called. A client that sent
+            # Expect: 100-continue is told to send the body once it is known to fit.
+            if self.is_chunked:
+                self.send_continue(connection)
+                self.receive_chunked_body(connection)
+            elif self.content_length is not None:
+                self.reserve(self.content_length)
+                self.send_continue(connection)
+                self.receive_content_length_body(connection)
+        except Exception:
+            self.release()
+            raise
+
+    # Send the interim 100 Continue response, if the client asked for it.
+    def send_continue(self, connection):
+        if self.expect_continue:
+            connection.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+    # Reserve memory for (a part of) the body.
+    def reserve(self, size):
+        if size < 0:
+            raise InvalidRequest()
+        if not self.limits:
+            return
+        if self.reserved + size > self.limits.max_body or not self.limits.reserve(size):
+            raise LimitExceeded(413)
+        self.reserved += size
+
+    # Give back the memory reserved for the body.
+    def release(self):
+        if self.reserved:
+            self.limits.release(self.reserved)
+            self.reserved = 0
 
     # Function to receive header, and process interesting information.
     def receive_header(self, connection):
-        data = bytes()
+        data = bytearray()
         chunk = bytes()
+        request_line_read = False
 
-        # Receive header, and decode
-        while b'\r\n\r\n' not in data:
+        # Receive header, and decode. Remember when the request started to arrive. Blank lines in front of the request
+        # line are skipped. Bytes are read one by one, so only the end of the data has to be checked.
+        while not data.endswith(b'\r\n\r\n'):
             chunk = connection.recv(1)
             if not chunk: break
+            if self.first_byte is None: self.first_byte = time.perf_counter()
             data += chunk
+            if data == b'\r\n': data.clear()
+
+            if not request_line_read and data.endswith(b'\r\n'):
+                request_line_read = True
+
+            if self.limits:
+                if not request_line_read and len(data) > self.limits.max_request_line:
+                    raise LimitExceeded(414)
+                if len(data) > self.limits.max_header:
+                    raise LimitExceeded(431)
 
         data = data.decode()
 
@@ -61,55 +152,77 @@ class Separator:
         # Check all useful header fields
         for key in header_elements:
             if key == "Content-Length":
+                if not (header_elements[key].isascii() and header_elements[key].isdigit()):
+                    raise InvalidRequest()
                 self.content_length = int(header_elements[key])
             if key == "Transfer-Encoding":
                 self.is_chunked = True
+            if key == "Expect" and header_elements[key].lower() == "100-continue":
+                self.expect_continue = True
 
         return data.encode()
 
-    # Function to receive chunked bodies.
-    def receive_chunked_body(self, connection):
+    # Function to receive chunked bodies. The chunks are added to a bytearray, which grows in place.
+    def receive_chunked_body(self, connection, chunk_size=65536):
+        self.body = bytearray()
+
         while True:
-            # Get length of the next chunk
-            length = bytes()
-            while b'\r\n' not in length:
-                length += connection.recv(1)
-            length = int(length.decode(self.encoding), 16)
+            # Get length of the next chunk. The line is limited like the request line, and must be a hexadecimal
+            # number (optionally followed by chunk extensions).
+            length = bytearray()
+            while not length.endswith(b'\r\n'):
+                part = connection.recv(1)
+                if not part:
+                    raise ConnectionError("connection closed while reading a chunk size")
+                length += part
+                if self.limits and len(length) > self.limits.max_request_line:
+                    raise InvalidRequest()
+
+            length = length.decode(self.encoding).split(";")[0].strip()
+            if not length or any(c not in string.hexdigits for c in length):
+                raise InvalidRequest()
+            length = int(length, 16)
 
             # If last chunk has been read, return. Otherwise, read content of chunk
             if length == 0:
                 connection.recv(2)
                 return
-            remaining = length + 2  # +2 for \r\n
+            self.reserve(length)
 
-            chunk = b''
+            remaining = length
             while remaining > 0:
-                if remaining > 1024:
-                    part = connection.recv(1024)
-                else:
-                    part = connection.recv(remaining)
+                part = connection.recv(min(remaining, chunk_size))
+                if not part:
+                    raise ConnectionError("connection closed while reading a chunk")
 
-                chunk += part
+                self.body += part
                 remaining -= len(part)
 
-            self.body += chunk
-
-    # Function to receive a body with content_length. Receives in chunks of 1024 by default, until there is less than
-    # 1024 bytes of data left.
-    def receive_content_length_body(self, connection, chunk_size=1024):
-        data = bytes()
-
-        length = self.content_length
-        while length > 0:
-            if length > chunk_size:
-                part = connection.recv(chunk_size)
-            else:
-                part = connection.recv(length)
-            data += part
-            length -= len(part)
-
+            # Read the \r\n behind the chunk
+            end = bytearray()
+            while len(end) < 2:
+                part = connection.recv(2 - len(end))
+                if not part:
+                    raise ConnectionError("connection closed while reading a chunk")
+                end += part
+            if end != b'\r\n':
+                raise InvalidRequest()
+
+    # Function to receive a body with content_length. The body is received directly into a buffer of that size, in
+    # chunks of 64 KiB by default, so it is never copied.
+    def receive_content_length_body(self, connection, chunk_size=65536):
+        data = bytearray(self.content_length)
+        view = memoryview(data)
+
+        received = 0
+        while received < self.content_length:
+            n = connection.recv_into(view[received:], min(self.content_length - received, chunk_size))
+            if not n:
+                raise ConnectionError("connection closed while reading the body")
+            received += n
+
+        view.release()
         self.body = data
-        empty_socket(connection)
 
 
 ##############################
@@ -175,27 +288,223 @@ class Request:
 ##############################
 
 
+# Class used to time the phases of a request (read, parse, handle, send). Requests slower than slow_ms are logged with
+# their phases. A fraction (profile_rate) of the requests is profiled with cProfile and tracemalloc, and the results
+# are written to profile_dir. Only one request is profiled at a time, as both profilers can not be nested.
+class Tracer:
+    def __init__(self, slow_ms=None, profile_rate=0, profile_dir="profiles"):
+        self.slow_ms = slow_ms
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.profile_lock = threading.Lock()
+        self.profile_count = 0
+
+    # Start tracing a request. started is the moment its first byte arrived.
+    def begin(self, started):
+        trace = RequestTrace(self, started)
+
+        if self.profile_rate and random.random() < self.profile_rate and self.profile_lock.acquire(blocking=False):
+            trace.start_profile()
+
+        return trace
+
+    # Log a finished request if it was slow, and write its profile if it has one.
+    def end(self, trace, request):
+        total = sum(duration for phase, duration in trace.phases) * 1000
+
+        if self.slow_ms is not None and total >= self.slow_ms:
+            phases = ", ".join("%s %.2fms" % (phase, duration * 1000) for phase, duration in trace.phases)
+            print("[SLOW] %s %s %.2fms (%s)" % (request.method, request.uri, total, phases))
+
+        if trace.profiler:
+            self.dump(trace, request)
+
+    # Write the cProfile stats and the tracemalloc snapshot of a request to profile_dir. A profile that can not be
+    # written is logged and skipped, so the request is still answered.
+    def dump(self, trace, request):
+        try:
+            if not os.path.exists(self.profile_dir):
+                os.makedirs(self.profile_dir)
+
+            # The profile lock is held, so the counter can be used safely.
+            self.profile_count += 1
+            path = os.path.join(self.profile_dir, self.profile_name(request))
+
+            trace.profiler.dump_stats(path + ".prof")
+            trace.snapshot.dump(path + ".tracemalloc")
+        except OSError as e:
+            print("[PROFILE] Could not write the profile of %s %s: %s" % (request.method, request.uri[:100], e))
+        finally:
+            trace.profiler = None
+            self.profile_lock.release()
+
+
+    # File name of a profile, without extension. Only the start of the URI is kept, with characters that are not
+    # safe in file names replaced, so long URIs do not make a name that is too long. The hash keeps names unique.
+    def profile_name(self, request):
+        uri = "".join(c if c.isalnum() or c in "-._" else "_" for c in request.uri[:50])
+        digest = hashlib.sha1(request.uri.encode()).hexdigest()[:8]
+        return "%s-%d-%s-%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), self.profile_count, request.method, uri, digest)
+
+
+# Class holding the phases of one request.
+class RequestTrace:
+    def __init__(self, tracer, started):
+        self.tracer = tracer
+        self.phases = []
+        self.last = started
+        self.profiler = None
+        self.snapshot = None
+
+    # End the current phase.
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def start_profile(self):
+        tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profile(self):
+        if self.profiler and self.snapshot is None:
+            self.profiler.disable()
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    # Stop without logging (when the request could not be processed). Does nothing if the trace has been ended.
+    def abort(self):
+        if self.profiler:
+            self.stop_profile()
+            self.profiler = None
+            self.tracer.profile_lock.release()
+
+
+# Class used to decide which requests are served when the server is overloaded. Three checks are made:
+# - every client IP has a token bucket of burst requests, refilled at rate requests per second (no limit if rate is
+#   None). This is checked with take_token as soon as the header has been read, so refused bodies are never read;
+# - at most max_concurrent requests are processed at the same time, the others wait for a slot (at most max_delay
+#   seconds);
+# - when the time requests wait for a slot has stayed above target_delay for a whole interval, the queue is standing:
+#   requests that can not get a slot right away are refused instead of queued, until a request gets a slot in time.
+# Refused requests are answered with 503 and a Retry-After. Connections above max_connections are refused as well.
+class AdmissionControl:
+    def __init__(self, rate=None, burst=10, max_concurrent=32, max_connections=512, target_delay=0.05, interval=0.1,
+                 max_delay=1):
+        self.rate = rate
+        self.burst = burst
+        self.max_connections = max_connections
+        self.target_delay = target_delay
+        self.interval = interval
+        self.max_delay = max_delay
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.buckets = {}
+        self.connections = 0
+        self.overloaded_since = None
+        self.lock = threading.Lock()
+
+    # Called for every new connection. Returns False if there are too many connections already.
+    def open_connection(self):
+        with self.lock:
+            if self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def close_connection(self):
+        with self.lock:
+            self.connections -= 1
+
+    # Take a token from the bucket of a client. Returns None if there was one, otherwise the number of seconds until
+    # there will be one.
+    def take_token(self, ip):
+        if self.rate is None:
+            return None
+
+        now = time.monotonic()
+        with self.lock:
+            # Forget the clients with a full bucket, so the buckets do not grow without limit.
+            if len(self.buckets) > 10000:
+                self.buckets = {k: v for k, v in self.buckets.items()
+                                if v[0] + (now - v[1]) * self.rate < self.burst}
+
+            tokens, last = self.buckets.get(ip, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[ip] = (tokens, now)
+                return (1 - tokens) / self.rate
+
+            self.buckets[ip] = (tokens - 1, now)
+            return None
+
+    # Wait for a slot to process a request. Returns None if one was acquired (give it back with release), otherwise the
+    # number of seconds the client should wait before retrying.
+    def admit(self):
+        start = time.monotonic()
+        with self.lock:
+            standing = self.overloaded_since is not None and start - self.overloaded_since > self.interval
+
+        if standing:
+            acquired = self.slots.acquire(blocking=False)
+        else:
+            acquired = self.slots.acquire(timeout=self.max_delay)
+        if not acquired:
+            return 1
+
+        # Keep track of the queue delay.
+        delay = time.monotonic() - start
+        with self.lock:
+            if delay < self.target_delay:
+                self.overloaded_since = None
+            elif self.overloaded_since is None:
+                self.overloaded_since = start
+
+        return None
+
+    def release(self):
+        self.slots.release()
+
+
+##############################
+
+
 # Main class. This server checks a port for incoming connections. If there is one, makes a serverThread to
 # process further interactions
 class Server:
-    def __init__(self, host='127.0.0.1', port=9000):
+    def __init__(self, host='127.0.0.1', port=9000, tracer=None, limits=None, admission=None):
         self.host = host
         self.port = port
+        self.tracer = tracer
+        self.limits = limits or Limits()
+        self.admission = admission or AdmissionControl()
 
     def start(self):
         # Make connection, and listen to port.
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((self.host, self.port))
-        sock.listen(5)
+        sock.listen(128)
 
         print("Listening at", sock.getsockname())
 
-        # While True, listen to port, and make thread there is an incoming connection.
+        # While True, listen to port, and make thread there is an incoming connection. If there are too many
+        # connections, answer with 503 right away, using one ServerThread that is never started.
+        refuser = ServerThread(None, None)
         while True:
             conn, address = sock.accept()
             print("Connection initiated with:", address)
-            thread = ServerThread(conn, address)
+
+            if not self.admission.open_connection():
+                try:
+                    conn.send(refuser.handle_503(None))
+                except OSError:
+                    pass
+                conn.close()
+                print("Refused connection with:", address)
+                continue
+
+            thread = ServerThread(conn, address, self.tracer, self.limits, self.admission)
             thread.start()
 
 
@@ -203,32 +512,81 @@ class Server:
 
 
 # ServerThread class. This class defines everything needed to further handle the connection with a client.
-# It processes all the information.
+# It processes all the information. If a tracer is given, the phases of every request are timed. Requests are checked
+# against limits, and only processed when admission allows it.
 class ServerThread(threading.Thread):
-    def __init__(self, connection, address):
+    def __init__(self, connection, address, tracer=None, limits=None, admission=None):
         threading.Thread.__init__(self)
         self.connection = connection
         self.address = address
+        self.tracer = tracer
+        self.limits = limits
+        self.admission = admission
 
     def run(self):
+        try:
+            self.process()
+        finally:
+            self.connection.close()
+            if self.admission:
+                self.admission.close_connection()
+
+    # Called by Separator when the header of a request has been read. Refuses the request if the client is over its
+    # rate, before its body is read.
+    def check_rate(self, sep):
+        if self.admission:
+            retry_after = self.admission.take_token(self.address[0])
+            if retry_after is not None:
+                raise Refused(retry_after)
+
+    def process(self):
         keep_connection = True
 
         # Eternal loop, until client closes or asks to close the connection.
         while keep_connection:
 
             # Try receiving. If an error occurs, it means the connection has been closed on the client side.
-            # In that case, break while loop.
+            # In that case, break while loop. If the request is too large or malformed, answer with the matching error
+            # before the rest is read. The rest of the request can not be skipped, so the connection is closed.
             try:
-                sep = Separator(self.connection)
+                sep = Separator(self.connection, self.limits, self.check_rate)
+            except (LimitExceeded, InvalidRequest) as e:
+                self.connection.send(getattr(self, 'handle_%d' % e.status_code)(None))
+                break
+            except Refused as e:
+                self.connection.send(self.handle_503(None, e.retry_after))
+                break
             except Exception:
                 break
 
+            # Start tracing. The time spent waiting for the request is not counted.
+            trace = None
+            if self.tracer:
+                trace = self.tracer.begin(sep.first_byte or time.perf_counter())
+                trace.mark("read")
+
             # Process request.
             try:
                 request = Request(sep.header, sep.body)
             except Exception:
+                if trace: trace.abort()
+                sep.release()
                 break
 
+            if trace: trace.mark("parse")
+
+            # Wait until the request may be processed. If it is refused, answer with 503 and close the connection, so
+            # the thread is freed.
+            if self.admission:
+                retry_after = self.admission.admit()
+                if retry_after is not None:
+                    if trace: trace.abort()
+                    sep.release()
+                    self.connection.send(self.handle_503(request, retry_after))
+                    break
+
+                if trace: trace.mark("admit")
+
             # Get the correct handler for the given method. Also checks for errors (HTTP version, Host,...).
             try:
                 if not request.http_version == "HTTP/1.1":
@@ -240,14 +598,29 @@ class ServerThread(threading.Thread):
             except AttributeError:
                 handler = self.handle_501
 
-            # Make response
+            # Make and send response. Whatever happens, the admission slot is given back. If the response can not be
+            # sent, the connection is closed.
             try:
-                response = handler(request)
-            except Exception:
-                response = self.handle_500()
+                try:
+                    response = handler(request)
+                except Exception:
+                    response = self.handle_500(request)
+
+                if trace: trace.mark("handle")
 
-            # Send response
-            self.connection.send(response)
+                # Send response
+                self.connection.send(response)
+
+                if trace:
+                    trace.mark("send")
+                    trace.stop_profile()
+                    self.tracer.end(trace, request)
+            except Exception:
+                break
+            finally:
+                sep.release()
+                if self.admission: self.admission.release()
+                if trace: trace.abort()
 
             # If connection: close header has been sent, close the connection.
             if not request.keep_connection:
@@ -273,8 +646,12 @@ class ServerThread(threading.Thread):
         400: 'Bad Request',  # Host not present
         404: 'Not Found',  # File not found
         412: 'Precondition Failed',  # Response if file has been modified (PUT, POST, If-Unmodified-Since)
+        413: 'Payload Too Large',  # Body larger than allowed, or no memory left to receive it
+        414: 'URI Too Long',  # Request line longer than allowed
+        431: 'Request Header Fields Too Large',  # Header larger than allowed
         500: 'Internal Server Error',  # Response if there was an error while processing the intended response
         501: 'Not Implemented',  # Response for unimplemented methods (DELETE, OPTIONS,...)
+        503: 'Service Unavailable',  # Request refused by admission control (client over its rate, server overloaded)
         505: 'HTTP Version Not Supported',  # Response for unsupported HTTP versions
     }
 
@@ -356,6 +733,60 @@ class ServerThread(threading.Thread):
 
         return b"".join([response_line, response_headers, blank_line, response_body, blank_line, blank_line])
 
+    # 413 handler (Payload too large). The connection is closed afterwards.
+    def handle_413(self, request):
+        response_line = self.response_line(status_code=413)
+
+        blank_line = b"\r\n"
+
+        response_body = b"<h1>413 Payload Too Large</h1>"
+
+        extra_headers = {'Content-Type': 'text/html', 'Content-Length': len(response_body), 'Connection': 'close'}
+        response_headers = self.response_headers(extra_headers)
+
+        return b"".join([response_line, response_headers, blank_line, response_body, blank_line, blank_line])
+
+    # 414 handler (URI too long). The connection is closed afterwards.
+    def handle_414(self, request):
+        response_line = self.response_line(status_code=414)
+
+        blank_line = b"\r\n"
+
+        response_body = b"<h1>414 URI Too Long</h1>"
+
+        extra_headers = {'Content-Type': 'text/html', 'Content-Length': len(response_body), 'Connection': 'close'}
+        response_headers = self.response_headers(extra_headers)
+
+        return b"".join([response_line, response_headers, blank_line, response_body, blank_line, blank_line])
+
+    # 431 handler (Request header fields too large). The connection is closed afterwards.
+    def handle_431(self, request):
+        response_line = self.response_line(status_code=431)
+
+        blank_line = b"\r\n"
+
+        response_body = b"<h1>431 Request Header Fields Too Large</h1>"
+
+        extra_headers = {'Content-Type': 'text/html', 'Content-Length': len(response_body), 'Connection': 'close'}
+        response_headers = self.response_headers(extra_headers)
+
+        return b"".join([response_line, response_headers, blank_line, response_body, blank_line, blank_line])
+
+    # 503 handler (Service unavailable). Tells the client to retry after retry_after seconds. The connection is closed
+    # afterwards.
+    def handle_503(self, request, retry_after=1):
+        response_line = self.response_line(status_code=503)
+
+        blank_line = b"\r\n"
+
+        response_body = b"<h1>503 Service Unavailable</h1>"
+
+        extra_headers = {'Content-Type': 'text/html', 'Content-Length': len(response_body),
+                         'Retry-After': max(1, math.ceil(retry_after)), 'Connection': 'close'}
+        response_headers = self.response_headers(extra_headers)
+
+        return b"".join([response_line, response_headers, blank_line, response_body, blank_line, blank_line])
+
     # GET handler.
     def handle_GET(self, request):
         filename = request.uri.strip('/')  # remove the slash from the request URI
@@ -457,10 +888,9 @@ class ServerThread(threading.Thread):
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        # (Over)Write file
-        with open(filename, 'w') as out:
-            print(request.body.decode())
-            out.write(request.body.decode(request.encoding))
+        # (Over)Write file. The body is written as it was received, so binary files are kept intact.
+        with open(filename, 'wb') as out:
+            out.write(request.body)
             out.close()
 
         response_line = self.response_line(status_code=200)
@@ -493,8 +923,8 @@ class ServerThread(threading.Thread):
 
         # Check if file already exists. If yes, append. Otherwise, create new one.
         if os.path.isfile(filename):
-            with open(filename, 'a') as out:
-                out.write(request.body.decode(request.encoding))
+            with open(filename, 'ab') as out:
+                out.write(request.body)
                 out.close()
             response_line = self.response_line(status_code=200)
         else:
@@ -502,8 +932,8 @@ class ServerThread(threading.Thread):
             if not os.path.exists(directory):
                 os.makedirs(directory)
 
-            with open(filename, 'w') as out:
-                out.write(request.body.decode(request.encoding))
+            with open(filename, 'wb') as out:
+                out.write(request.body)
                 out.close()
 
             response_line = self.response_line(status_code=201)
@@ -519,5 +949,32 @@ class ServerThread(threading.Thread):
 
 
 if __name__ == '__main__':
-    server = Server()
+    parser = argparse.ArgumentParser(prog="server.py")
+    parser.add_argument("--slow-ms", type=float, help="log the phases of requests that take longer than this")
+    parser.add_argument("--profile-rate", type=float, default=0,
+                        help="fraction of requests to profile with cProfile and tracemalloc")
+    parser.add_argument("--profile-dir", default="profiles", help="folder to write the profiles to")
+    parser.add_argument("--max-request-line", type=int, default=8192, help="maximum length of the request line")
+    parser.add_argument("--max-header", type=int, default=65536, help="maximum size of the header")
+    parser.add_argument("--max-body", type=int, default=64 * 1024 * 1024, help="maximum size of a body")
+    parser.add_argument("--memory-budget", type=int, default=256 * 1024 * 1024,
+                        help="maximum size of all bodies held in memory at the same time")
+    parser.add_argument("--rate", type=float, help="maximum number of requests per second per client IP")
+    parser.add_argument("--burst", type=int, default=10, help="number of requests a client IP may send at once")
+    parser.add_argument("--max-concurrent", type=int, default=32, help="maximum number of requests processed at once")
+    parser.add_argument("--max-connections", type=int, default=512, help="maximum number of open connections")
+    parser.add_argument("--target-delay-ms", type=float, default=50,
+                        help="queue delay above which the server starts shedding requests")
+    args = parser.parse_args()
+
+    tracer = None
+    if args.slow_ms is not None or args.profile_rate:
+        tracer = Tracer(args.slow_ms, args.profile_rate, args.profile_dir)
+
+    limits = Limits(args.max_request_line, args.max_header, args.max_body, args.memory_budget)
+
+    admission = AdmissionControl(args.rate, args.burst, args.max_concurrent, args.max_connections,
+                                 args.target_delay_ms / 1000)
+
+    server = Server(tracer=tracer, limits=limits, admission=admission)
     server.start()